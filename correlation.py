@@ -1,12 +1,29 @@
 #!/usr/bin/python3
 
 # correlation.py
+import ctypes
+import ctypes.util
+import glob
+import hashlib
+import platform
+import signal
+import stat
 import subprocess
+import tempfile
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy
 import os
 
+try:
+    from numba import njit, prange
+except ImportError:
+    # numba is optional, compare() falls back to the NumPy implementation
+    njit = None
+    prange = range
+
 # seconds to sample audio file for
 sample_time = 500
 # number of points to scan cross correlation over
@@ -16,6 +33,15 @@ step = 1
 # minimum number of points that must overlap in cross correlation
 # exception is raised if this cannot be met
 min_overlap = 20
+# number of threads reading short clip fingerprints
+fingerprint_workers = 16
+# number of source windows correlated against all short clips at once
+window_batch = 64
+# sample rate and channel count of the PCM audio decoded by ffmpeg
+pcm_rate = 44100
+pcm_channels = 2
+# directory for files cached between runs
+cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'fpcalc-song-detection')
 
 fpcalc_cache = {}
 
@@ -23,27 +49,126 @@ def get_audio_duration(filename):
     out = subprocess.check_output(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1', filename])
     return int(float(out))
 
-def extract_audio_chunk_bytes(filename, offset, duration):
+def _pcm_decoder_cmd(filename, offset, duration):
+    # headerless signed 16-bit little endian PCM, so the reader needs no demuxing
+    return ['ffmpeg', '-ss', str(offset), '-t', str(duration), '-i', filename, '-f', 's16le', '-acodec', 'pcm_s16le',
+            '-ar', str(pcm_rate), '-ac', str(pcm_channels), '-hide_banner', '-loglevel', 'error', '-']
+
+# CHROMAPRINT_ALGORITHM_DEFAULT, the algorithm fpcalc uses
+_CHROMAPRINT_ALGORITHM = 1
+# bytes of PCM fed to libchromaprint at once
+_CHROMAPRINT_CHUNK = 1 << 16
+
+def _load_chromaprint():
     """
-    Extract a chunk of audio as WAV bytes from 'filename' starting at 'offset' seconds
-    for 'duration' seconds.
+    Load libchromaprint, the library behind fpcalc, or return None if it is
+    not installed.
     """
-    cmd = ['ffmpeg', '-ss', str(offset), '-t', str(duration), '-i', filename, '-f', 'wav', '-acodec', 'pcm_s16le', '-ar', '44100', '-ac', '2', '-hide_banner', '-loglevel', 'error', '-']
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = proc.communicate()
-    if proc.returncode != 0:
-        raise RuntimeError(f"ffmpeg failed: {err.decode()}")
-    return out
+    for name in (ctypes.util.find_library('chromaprint'), 'libchromaprint.so.1'):
+        if name is None:
+            continue
+        try:
+            lib = ctypes.CDLL(name)
+        except OSError:
+            continue
+        lib.chromaprint_new.argtypes = [ctypes.c_int]
+        lib.chromaprint_new.restype = ctypes.c_void_p
+        lib.chromaprint_free.argtypes = [ctypes.c_void_p]
+        lib.chromaprint_free.restype = None
+        lib.chromaprint_start.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+        lib.chromaprint_start.restype = ctypes.c_int
+        lib.chromaprint_feed.argtypes = [ctypes.c_void_p, numpy.ctypeslib.ndpointer(dtype=numpy.int16, flags='C_CONTIGUOUS'), ctypes.c_int]
+        lib.chromaprint_feed.restype = ctypes.c_int
+        lib.chromaprint_finish.argtypes = [ctypes.c_void_p]
+        lib.chromaprint_finish.restype = ctypes.c_int
+        lib.chromaprint_get_raw_fingerprint.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.POINTER(ctypes.c_uint32)), ctypes.POINTER(ctypes.c_int)]
+        lib.chromaprint_get_raw_fingerprint.restype = ctypes.c_int
+        lib.chromaprint_dealloc.argtypes = [ctypes.c_void_p]
+        lib.chromaprint_dealloc.restype = None
+        return lib
+    return None
+
+_chromaprint = _load_chromaprint()
+
+def _chromaprint_feed_stream(stream):
+    # fingerprint the s16le PCM read from 'stream' until it ends
+    ctx = _chromaprint.chromaprint_new(_CHROMAPRINT_ALGORITHM)
+    try:
+        if not _chromaprint.chromaprint_start(ctx, pcm_rate, pcm_channels):
+            raise RuntimeError("chromaprint_start failed")
+        while True:
+            chunk = stream.read(_CHROMAPRINT_CHUNK)
+            if not chunk:
+                break
+            # ffmpeg writes s16le, chromaprint reads native int16, which only
+            # costs a byte swap on big endian hosts
+            samples = numpy.frombuffer(chunk[:len(chunk) & ~1], dtype='<i2').astype(numpy.int16, copy=False)
+            if not _chromaprint.chromaprint_feed(ctx, samples, len(samples)):
+                raise RuntimeError("chromaprint_feed failed")
+        if not _chromaprint.chromaprint_finish(ctx):
+            raise RuntimeError("chromaprint_finish failed")
+        raw = ctypes.POINTER(ctypes.c_uint32)()
+        size = ctypes.c_int()
+        if not _chromaprint.chromaprint_get_raw_fingerprint(ctx, ctypes.byref(raw), ctypes.byref(size)):
+            raise RuntimeError("chromaprint_get_raw_fingerprint failed")
+        try:
+            return numpy.ctypeslib.as_array(raw, shape=(size.value,)).copy() if size.value > 0 else numpy.empty(0, dtype=numpy.uint32)
+        finally:
+            _chromaprint.chromaprint_dealloc(raw)
+    finally:
+        _chromaprint.chromaprint_free(ctx)
+
+def _chromaprint_fingerprint(filename, offset, duration):
+    """
+    Feed the PCM decoded by ffmpeg to libchromaprint in chunks and return the
+    raw fingerprint, without going through fpcalc and its text output.
+    """
+    # ffmpeg's messages go to a file, see calculate_fingerprint
+    with tempfile.TemporaryFile() as ffmpeg_stderr:
+        ffmpeg = subprocess.Popen(_pcm_decoder_cmd(filename, offset, duration), stdout=subprocess.PIPE, stderr=ffmpeg_stderr)
+        try:
+            fingerprints = _chromaprint_feed_stream(ffmpeg.stdout)
+            error = None
+        except RuntimeError as e:
+            error = e
+        finally:
+            ffmpeg.stdout.close()
+            ffmpeg.wait()
+        if ffmpeg.returncode != 0:
+            # a chromaprint error is usually caused by ffmpeg failing, report that first
+            ffmpeg_stderr.seek(0)
+            raise RuntimeError(f"ffmpeg failed: {ffmpeg_stderr.read().decode()}") from error
+    if error is not None:
+        raise error
+    return fingerprints
 
 def calculate_fingerprint(filename, offset=0, duration=sample_time):
     """
     Calculate the fingerprint of a chunk in 'filename' starting at 'offset' with 'duration' seconds,
-    using fpcalc reading WAV data from stdin.
+    streaming the raw PCM decoded by a single ffmpeg process straight into libchromaprint
+    if it is installed, or into fpcalc otherwise.
     """
+    if _chromaprint is not None:
+        print("Calculating fingerprint by libchromaprint for %s at offset %d" % (filename, offset))
+        return _chromaprint_fingerprint(filename, offset, duration)
     print("Calculating fingerprint by fpcalc for %s at offset %d" % (filename, offset))
-    audio_chunk_bytes = extract_audio_chunk_bytes(filename, offset, duration)
-    proc = subprocess.Popen(['fpcalc', '-raw', '-ts', '-'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=False)
-    stdout, stderr = proc.communicate(input=audio_chunk_bytes)
+    # ffmpeg's messages go to a file, a pipe nobody reads while fpcalc runs
+    # would block ffmpeg once it fills up and stall fpcalc with it
+    with tempfile.TemporaryFile() as ffmpeg_stderr:
+        ffmpeg = subprocess.Popen(_pcm_decoder_cmd(filename, offset, duration), stdout=subprocess.PIPE, stderr=ffmpeg_stderr)
+        fpcalc_cmd = ['fpcalc', '-raw', '-ts', '-length', str(duration), '-format', 's16le', '-rate', str(pcm_rate), '-channels', str(pcm_channels), '-']
+        proc = subprocess.Popen(fpcalc_cmd, stdin=ffmpeg.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=False)
+        # only fpcalc holds the read end now, so ffmpeg sees a closed pipe if fpcalc exits
+        ffmpeg.stdout.close()
+        stdout, stderr = proc.communicate()
+        ffmpeg.wait()
+        ffmpeg_stderr.seek(0)
+        ffmpeg_err = ffmpeg_stderr.read()
+    # a closed pipe is the only ffmpeg failure left to fpcalc, which may stop
+    # reading a few samples before ffmpeg is done writing 'duration' seconds
+    broken_pipe = ffmpeg.returncode == -signal.SIGPIPE or b'Broken pipe' in ffmpeg_err
+    if ffmpeg.returncode != 0 and not broken_pipe:
+        raise RuntimeError(f"ffmpeg failed: {ffmpeg_err.decode()}")
     if proc.returncode != 0:
         raise RuntimeError(f"fpcalc failed: {stderr.decode()}")
     fpcalc_out = stdout.decode()
@@ -51,8 +176,70 @@ def calculate_fingerprint(filename, offset=0, duration=sample_time):
     if fingerprint_index == -1:
         raise ValueError("Fingerprint not found in fpcalc output")
     fingerprint_str = fpcalc_out[fingerprint_index + len('FINGERPRINT='):].strip()
-    # convert fingerprint to list of integers
-    fingerprints = list(map(int, fingerprint_str.split(',')))
+    # parse fingerprint straight into an array of 32-bit integers
+    fingerprints = numpy.fromstring(fingerprint_str, dtype=numpy.uint32, sep=',')
+    return fingerprints
+
+def _disk_cache_path(filename, *key):
+    # the entry of a file is invalidated by any change to the file, inputs
+    # other than regular files (URLs, devices) have no entry and return None
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    if not stat.S_ISREG(st.st_mode):
+        return None
+    key = repr((os.path.abspath(filename), st.st_mtime_ns, st.st_size) + key)
+    return os.path.join(cache_dir, 'fingerprints', hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+def _load_disk_cache(path):
+    try:
+        return numpy.load(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, EOFError) as e:
+        # e.g. an empty entry left behind by a crash, drop it so the
+        # fingerprint is calculated and stored again
+        print(f"Ignoring unreadable cached fingerprint {path}: {e}")
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return None
+
+def _save_disk_cache(path, fingerprints):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, "wb") as f:
+            numpy.save(f, fingerprints)
+            # make sure the data is on disk before the rename makes it visible
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except OSError as e:
+        # the cache is only an optimization, carry on without it
+        print(f"Failed to cache fingerprint in {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def cached_fingerprint(filename, offset=0, duration=sample_time):
+    """
+    Same as calculate_fingerprint, but the result is stored in cache_dir and
+    reused by later runs until 'filename' changes. Inputs other than regular
+    files are fingerprinted without the cache.
+    """
+    # anything that changes the decoded audio or its fingerprint is part of the key
+    backend = 'libchromaprint' if _chromaprint is not None else 'fpcalc'
+    path = _disk_cache_path(filename, backend, _CHROMAPRINT_ALGORITHM, pcm_rate, pcm_channels, offset, duration)
+    if path is None:
+        return calculate_fingerprint(filename, offset, duration)
+    fingerprints = _load_disk_cache(path)
+    if fingerprints is None:
+        # raises unless ffmpeg and the fingerprinter both succeeded, so a
+        # truncated fingerprint never reaches the cache
+        fingerprints = calculate_fingerprint(filename, offset, duration)
+        _save_disk_cache(path, fingerprints)
     return fingerprints
 
 def get_fingerprints(dirname):
@@ -63,15 +250,15 @@ def get_fingerprints(dirname):
     return result
 
 def get_fingerprint(filename):
-    fpcalc_content = fpcalc_cache.get(filename)
-    if fpcalc_content is None:
+    fingerprints = fpcalc_cache.get(filename)
+    if fingerprints is None:
         f = open(filename, "r")
         fpcalc_content = ''.join(f.readlines())
         f.close()
-        fpcalc_cache.update({filename: fpcalc_content})
-    fingerprint_index = fpcalc_content.find('FINGERPRINT=') + 12
-    # convert fingerprint to list of integers
-    fingerprints = list(map(int, fpcalc_content[fingerprint_index:].split(',')))
+        fingerprint_index = fpcalc_content.find('FINGERPRINT=') + 12
+        # parse fingerprint straight into an array of 32-bit integers
+        fingerprints = numpy.fromstring(fpcalc_content[fingerprint_index:], dtype=numpy.uint32, sep=',')
+        fpcalc_cache.update({filename: fingerprints})
     return fingerprints
   
 # returns correlation between lists
@@ -80,15 +267,14 @@ def correlation(listx, listy):
         # Error checking in main program should prevent us from ever being
         # able to get here.
         raise Exception('Empty lists cannot be correlated.')
-    if len(listx) > len(listy):
-        listx = listx[:len(listy)]
-    elif len(listx) < len(listy):
-        listy = listy[:len(listx)]
+    n = min(len(listx), len(listy))
+    listx = numpy.asarray(listx[:n], dtype=numpy.uint32)
+    listy = numpy.asarray(listy[:n], dtype=numpy.uint32)
     
-    covariance = 0
-    for i in range(len(listx)):
-        covariance += 32 - bin(listx[i] ^ listy[i]).count("1")
-    covariance = covariance / float(len(listx))
+    # number of differing bits over all 32-bit words
+    xor = numpy.bitwise_xor(listx, listy)
+    popcount = int(numpy.bitwise_count(xor).sum())
+    covariance = (32 * n - popcount) / float(n)
     
     return covariance / 32
   
@@ -108,6 +294,332 @@ def cross_correlation(listx, listy, offset):
     #raise Exception('Overlap too small: %i' % min(len(listx), len(listy)))
     return correlation(listx, listy)
   
+# SWAR population count of a 64-bit word
+def _popcount64(v):
+    v = v - ((v >> numpy.uint64(1)) & numpy.uint64(0x5555555555555555))
+    v = (v & numpy.uint64(0x3333333333333333)) + ((v >> numpy.uint64(2)) & numpy.uint64(0x3333333333333333))
+    v = (v + (v >> numpy.uint64(4))) & numpy.uint64(0x0F0F0F0F0F0F0F0F)
+    return numpy.int64((v * numpy.uint64(0x0101010101010101)) >> numpy.uint64(56))
+
+# pack pairs of consecutive 32-bit words into 64-bit words, row p holds
+# the pairs starting at a[p], so any start index can be read as whole words
+def _pack_pairs(a):
+    pairs = numpy.zeros((2, len(a) // 2), dtype=numpy.uint64)
+    for p in range(2):
+        for j in range((len(a) - p) // 2):
+            i = p + 2 * j
+            pairs[p, j] = numpy.uint64(a[i]) | (numpy.uint64(a[i + 1]) << numpy.uint64(32))
+    return pairs
+
+# range [k_lo, k_hi) of the sweep offsets -span + k * step for which x and
+# y overlap by at least min_overlap points, the other offsets are skipped
+def _useful_offsets(lx, ly, span, step, min_overlap):
+    n_offsets = (2 * span) // step + 1
+    if lx < min_overlap or ly < min_overlap:
+        return 0, 0
+    lo = min_overlap - ly + span
+    hi = lx - min_overlap + span
+    k_lo = (lo + step - 1) // step if lo > 0 else 0
+    k_hi = min(hi // step + 1, n_offsets) if hi >= 0 else 0
+    return min(k_lo, k_hi), k_hi
+
+# number of 64-bit words compared between early exit checks in _sweep
+_block_pairs = 128
+
+# cross correlate x and y with offsets from -span to span in a single pass,
+# offsets with less than min_overlap overlapping points are NaN, as are
+# offsets that differ in too many bits to reach a threshold above 0
+def _sweep(x, y, span, step, min_overlap, threshold):
+    x_pairs = _pack_pairs(x)
+    y_pairs = _pack_pairs(y)
+    corr_xy = numpy.full((2 * span) // step + 1, numpy.nan)
+    k_lo, k_hi = _useful_offsets(len(x), len(y), span, step, min_overlap)
+    for k in range(k_lo, k_hi):
+        offset = -span + k * step
+        if offset > 0:
+            x_start, y_start = offset, 0
+        else:
+            x_start, y_start = 0, -offset
+        n = min(len(x) - x_start, len(y) - y_start)
+        xp = x_pairs[x_start & 1]
+        yp = y_pairs[y_start & 1]
+        jx = x_start >> 1
+        jy = y_start >> 1
+        # the offset cannot reach threshold once more than limit bits differ
+        limit = int((1.0 - threshold) * 32.0 * n) + 1 if threshold > 0 else 32 * n
+        popcount = 0
+        n_pairs = n // 2
+        for block in range(0, n_pairs, _block_pairs):
+            if popcount > limit:
+                break
+            for j in range(block, min(block + _block_pairs, n_pairs)):
+                popcount += _popcount64(xp[jx + j] ^ yp[jy + j])
+        if n & 1:
+            popcount += _popcount64(numpy.uint64(x[x_start + n - 1] ^ y[y_start + n - 1]))
+        if popcount > limit:
+            corr_xy[k] = numpy.nan
+        else:
+            corr_xy[k] = (32 * n - popcount) / (32.0 * n)
+    return corr_xy
+
+# cross correlate every source window with every short clip, spans[w, c]
+# is the span used for the pair and pairs with a span below min_overlap are
+# left NaN, window w is source[window_starts[w]:][:window_lens[w]] and clip c
+# is clips[clip_starts[c]:][:clip_lens[c]]
+def _sweep_windows(source, window_starts, window_lens, clips, clip_starts, clip_lens, spans, step, min_overlap, threshold):
+    n_offsets = (2 * spans.max()) // step + 1
+    corr = numpy.full((len(window_starts), len(clip_starts), n_offsets), numpy.nan)
+    for w in prange(len(window_starts)):
+        window = source[window_starts[w]:window_starts[w] + window_lens[w]]
+        for c in range(len(clip_starts)):
+            span_to_use = spans[w, c]
+            if span_to_use < min_overlap:
+                continue
+            clip = clips[clip_starts[c]:clip_starts[c] + clip_lens[c]]
+            corr_xy = _sweep(window, clip, span_to_use, step, min_overlap, threshold)
+            corr[w, c, :len(corr_xy)] = corr_xy
+    return corr
+
+if njit is not None:
+    _popcount64 = njit(cache=True)(_popcount64)
+    _useful_offsets = njit(cache=True)(_useful_offsets)
+    _pack_pairs = njit(cache=True)(_pack_pairs)
+    _sweep = njit(cache=True, fastmath=True)(_sweep)
+    _sweep_windows = njit(cache=True, fastmath=True, parallel=True)(_sweep_windows)
+    _numba_kernels = True
+else:
+    _numba_kernels = False
+
+# same sweeps as _sweep and _sweep_windows, compiled natively so the
+# XOR/popcount loop can use the POPCNT and vector instructions of the host
+# CPU and the windows are spread over all cores with OpenMP
+_SWEEP_C_SOURCE = r"""
+#include <math.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <string.h>
+
+#define BLOCK 256
+
+/* range [*k_lo, *k_hi) of the offsets -span + k * step for which x and y
+   overlap by at least min_overlap points */
+static void useful_offsets(int lx, int ly, int span, int step, int min_overlap, int n_offsets,
+                           int *k_lo, int *k_hi)
+{
+    *k_lo = *k_hi = 0;
+    if (lx < min_overlap || ly < min_overlap)
+        return;
+    int lo = min_overlap - ly + span;
+    int hi = lx - min_overlap + span;
+    if (hi < 0)
+        return;
+    *k_hi = hi / step + 1 < n_offsets ? hi / step + 1 : n_offsets;
+    *k_lo = lo > 0 ? (lo + step - 1) / step : 0;
+    if (*k_lo > *k_hi)
+        *k_lo = *k_hi;
+}
+
+void sweep(const uint32_t *x, int lx, const uint32_t *y, int ly,
+           int span, int step, int min_overlap, double threshold, double *out)
+{
+    int n_offsets = (2 * span) / step + 1;
+    int k_lo, k_hi;
+    useful_offsets(lx, ly, span, step, min_overlap, n_offsets, &k_lo, &k_hi);
+    for (int k = 0; k < n_offsets; k++)
+        out[k] = NAN;
+    for (int k = k_lo; k < k_hi; k++) {
+        int offset = -span + k * step;
+        int x_start = offset > 0 ? offset : 0;
+        int y_start = offset > 0 ? 0 : -offset;
+        int n = lx - x_start < ly - y_start ? lx - x_start : ly - y_start;
+        const uint32_t *xs = x + x_start;
+        const uint32_t *ys = y + y_start;
+        /* the offset cannot reach threshold once more than limit bits differ */
+        uint64_t limit = threshold > 0.0 ? (uint64_t)((1.0 - threshold) * 32.0 * n) + 1 : 32 * (uint64_t)n;
+        uint64_t popcount = 0;
+        for (int block = 0; block < n && popcount <= limit; block += BLOCK) {
+            int end = block + BLOCK < n ? block + BLOCK : n;
+            int i = block;
+            for (; i + 2 <= end; i += 2) {
+                uint64_t a, b;
+                memcpy(&a, xs + i, sizeof(a));
+                memcpy(&b, ys + i, sizeof(b));
+                popcount += __builtin_popcountll(a ^ b);
+            }
+            if (i < end)
+                popcount += __builtin_popcount(xs[i] ^ ys[i]);
+        }
+        out[k] = popcount > limit ? NAN : (32.0 * n - popcount) / (32.0 * n);
+    }
+}
+
+void sweep_windows(const uint32_t *source, const int64_t *window_starts, const int32_t *window_lens, int n_windows,
+                   const uint32_t *clips, const int64_t *clip_starts, const int32_t *clip_lens, int n_clips,
+                   const int32_t *spans, int step, int min_overlap, double threshold, int n_offsets, double *out)
+{
+    #pragma omp parallel for collapse(2) schedule(dynamic)
+    for (int w = 0; w < n_windows; w++) {
+        for (int c = 0; c < n_clips; c++) {
+            double *corr = out + ((size_t)w * n_clips + c) * n_offsets;
+            for (int k = 0; k < n_offsets; k++)
+                corr[k] = NAN;
+            int span = spans[(size_t)w * n_clips + c];
+            if (span < min_overlap)
+                continue;
+            sweep(source + window_starts[w], window_lens[w],
+                  clips + clip_starts[c], clip_lens[c],
+                  span, step, min_overlap, threshold, corr);
+        }
+    }
+}
+"""
+
+def _host_key():
+    # -march=native output only runs on CPUs with the same instruction set,
+    # so a cache_dir shared between machines needs one library per CPU type
+    flags = ''
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = next((line for line in f if line.startswith(('flags', 'Features'))), '')
+    except OSError:
+        flags = platform.processor()
+    return hashlib.sha1(f"{platform.machine()} {flags}".encode()).hexdigest()[:12]
+
+def _load_native():
+    """
+    Build _SWEEP_C_SOURCE with gcc into cache_dir (once per source version and
+    CPU type) and return the loaded library, or None if no compiler or library
+    is available.
+    """
+    host = _host_key()
+    digest = hashlib.sha1(_SWEEP_C_SOURCE.encode()).hexdigest()[:16]
+    lib_path = os.path.join(cache_dir, f"sweep-{host}-{digest}.so")
+    if not os.path.exists(lib_path):
+        src_path = os.path.join(cache_dir, f"sweep-{host}-{digest}-{os.getpid()}.c")
+        tmp_path = src_path[:-2] + '.so'
+        cmd = ['gcc', '-O3', '-march=native', '-shared', '-fPIC', '-o', tmp_path, src_path]
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(src_path, "w") as f:
+                f.write(_SWEEP_C_SOURCE)
+            try:
+                subprocess.run(cmd + ['-fopenmp'], check=True, capture_output=True)
+            except subprocess.CalledProcessError:
+                # no OpenMP support, windows are swept on a single core
+                subprocess.run(cmd, check=True, capture_output=True)
+            # rename so concurrent runs never load a half written library
+            os.replace(tmp_path, lib_path)
+        except (OSError, subprocess.CalledProcessError):
+            return None
+        finally:
+            if os.path.exists(src_path):
+                os.remove(src_path)
+        # drop libraries of older source versions for this CPU type, builds
+        # in progress carry an extra -pid
+        for old_path in glob.glob(os.path.join(cache_dir, f"sweep-{host}-*.so")):
+            if old_path != lib_path and os.path.basename(old_path).count('-') == 2:
+                try:
+                    os.remove(old_path)
+                except OSError:
+                    pass
+    try:
+        lib = ctypes.CDLL(lib_path)
+    except OSError:
+        return None
+    uint32_array = numpy.ctypeslib.ndpointer(dtype=numpy.uint32, flags='C_CONTIGUOUS')
+    int32_array = numpy.ctypeslib.ndpointer(dtype=numpy.int32, flags='C_CONTIGUOUS')
+    double_array = numpy.ctypeslib.ndpointer(dtype=numpy.float64, flags='C_CONTIGUOUS')
+    lib.sweep.argtypes = [uint32_array, ctypes.c_int, uint32_array, ctypes.c_int,
+                          ctypes.c_int, ctypes.c_int, ctypes.c_int, ctypes.c_double, double_array]
+    lib.sweep.restype = None
+    int64_array = numpy.ctypeslib.ndpointer(dtype=numpy.int64, flags='C_CONTIGUOUS')
+    lib.sweep_windows.argtypes = [uint32_array, int64_array, int32_array, ctypes.c_int,
+                                  uint32_array, int64_array, int32_array, ctypes.c_int,
+                                  int32_array, ctypes.c_int, ctypes.c_int, ctypes.c_double, ctypes.c_int, double_array]
+    lib.sweep_windows.restype = None
+    return lib
+
+_native = _load_native()
+
+def sweep(x, y, span, step, threshold=0.0):
+    """
+    Cross correlate 'x' and 'y' with offsets from -span to span, using the
+    fastest available implementation: native C, then Numba, then NumPy.
+    Offsets with less than min_overlap overlapping points are NaN. With a
+    'threshold' above 0, offsets that cannot reach it may be NaN as well,
+    their comparison is abandoned as soon as too many bits differ.
+    """
+    if _native is not None:
+        corr_xy = numpy.empty((2 * span) // step + 1)
+        _native.sweep(numpy.ascontiguousarray(x, dtype=numpy.uint32), len(x),
+                      numpy.ascontiguousarray(y, dtype=numpy.uint32), len(y),
+                      span, step, min_overlap, threshold, corr_xy)
+        return corr_xy
+    if _numba_kernels:
+        return _sweep(x, y, span, step, min_overlap, threshold)
+    corr_xy = numpy.full((2 * span) // step + 1, numpy.nan)
+    k_lo, k_hi = _useful_offsets(len(x), len(y), span, step, min_overlap)
+    for k in range(k_lo, k_hi):
+        corr_xy[k] = cross_correlation(x, y, -span + k * step)
+    return corr_xy
+
+def concat_fingerprints(fingerprints):
+    """
+    Concatenate 'fingerprints' into one array for sweep_windows().
+
+    Returns:
+        tuple: (data, starts, lens), fingerprint i is data[starts[i]:starts[i] + lens[i]].
+    """
+    lens = numpy.array([len(fp) for fp in fingerprints], dtype=numpy.int32)
+    starts = numpy.zeros(len(fingerprints), dtype=numpy.int64)
+    numpy.cumsum(lens[:-1], out=starts[1:])
+    data = numpy.concatenate([numpy.asarray(fp, dtype=numpy.uint32) for fp in fingerprints]) if len(fingerprints) > 0 else numpy.empty(0, dtype=numpy.uint32)
+    return data, starts, lens
+
+def sweep_windows(source, window_starts, window_lens, clips, clip_starts, clip_lens, spans, step, threshold=0.0):
+    """
+    Cross correlate every window of 'source' with every clip of 'clips' in
+    parallel, using the span in spans[w, c] for each pair. Window w is
+    source[window_starts[w]:window_starts[w] + window_lens[w]] and clips are
+    laid out the same way (see concat_fingerprints()), so overlapping windows
+    of one source fingerprint share its memory instead of being copied. See
+    sweep() for 'threshold'.
+
+    Returns:
+        numpy.ndarray: corr[w, c] holds the sweep of the pair padded with NaN
+        to the largest span, pairs with a span below min_overlap are all NaN.
+    """
+    source = numpy.ascontiguousarray(source, dtype=numpy.uint32)
+    window_starts = numpy.ascontiguousarray(window_starts, dtype=numpy.int64)
+    window_lens = numpy.ascontiguousarray(window_lens, dtype=numpy.int32)
+    clips = numpy.ascontiguousarray(clips, dtype=numpy.uint32)
+    clip_starts = numpy.ascontiguousarray(clip_starts, dtype=numpy.int64)
+    clip_lens = numpy.ascontiguousarray(clip_lens, dtype=numpy.int32)
+    spans = numpy.ascontiguousarray(spans, dtype=numpy.int32)
+    max_span = max(int(spans.max(initial=0)), 0)
+    n_offsets = (2 * max_span) // step + 1
+    n_windows = len(window_starts)
+    n_clips = len(clip_starts)
+    if n_windows == 0 or n_clips == 0:
+        return numpy.full((n_windows, n_clips, n_offsets), numpy.nan)
+    if _native is not None:
+        corr = numpy.empty((n_windows, n_clips, n_offsets))
+        _native.sweep_windows(source, window_starts, window_lens, n_windows,
+                              clips, clip_starts, clip_lens, n_clips,
+                              spans, step, min_overlap, threshold, n_offsets, corr)
+        return corr
+    if _numba_kernels:
+        return _sweep_windows(source, window_starts, window_lens, clips, clip_starts, clip_lens, spans, step, min_overlap, threshold)
+    corr = numpy.full((n_windows, n_clips, n_offsets), numpy.nan)
+    for w in range(n_windows):
+        window = source[window_starts[w]:window_starts[w] + window_lens[w]]
+        for c in range(n_clips):
+            if spans[w, c] >= min_overlap:
+                clip = clips[clip_starts[c]:clip_starts[c] + clip_lens[c]]
+                corr_xy = sweep(window, clip, int(spans[w, c]), step, threshold)
+                corr[w, c, :len(corr_xy)] = corr_xy
+    return corr
+
 # cross correlate listx and listy with offsets from -span to span
 def compare(listx, listy, span, step):
     if span > min(len(listx), len(listy)):
@@ -116,33 +628,25 @@ def compare(listx, listy, span, step):
         raise Exception('span >= sample size: %i >= %i\n'
                         % (span, min(len(listx), len(listy)))
                         + 'Reduce span, reduce crop or increase sample_time.')
-    corr_xy = []
-    for offset in numpy.arange(-span, span + 1, step):
-        corr_xy.append(cross_correlation(listx, listy, offset))
-    return corr_xy
+    return sweep(listx, listy, span, step)
 
-# return index of maximum value in list
+# return index of maximum value in list, NaN values are ignored
 def max_index(listx):
-    max_index = 0
-    max_value = listx[0]
-    for i, value in enumerate(listx):
-        if value > max_value:
-            max_value = value
-            max_index = i
-    return max_index
+    return int(numpy.nanargmax(listx))
   
 def get_max_corr(corr, threshold=0.5):
     max_corr_index = max_index(corr)
     max_corr_offset = -span + max_corr_index * step
     return max_corr_index, max_corr_offset
 
-def is_match(corr_scores, threshold=0.75, min_consistent_offsets=3, max_offset_deviation=5):
+def is_match(corr, offsets, threshold=0.75, min_consistent_offsets=3, max_offset_deviation=5):
     """
     Determine if a match exists given correlation scores over multiple offsets.
 
     Args:
-        corr_scores (list of tuples): List of (correlation_value, offset) pairs, e.g.
-            [(0.80, -2), (0.78, -3), (0.82, -1), (0.45, 10)]
+        corr (numpy.ndarray): Correlation value for each offset, NaN where none was computed, e.g.
+            [0.80, 0.78, 0.82, 0.45]
+        offsets (numpy.ndarray): Offset of each correlation value, e.g. [-2, -3, -1, 10]
         threshold (float): Minimum correlation value to consider a 'high' correlation.
         min_consistent_offsets (int): Minimum number of high correlations with consistent offsets needed.
         max_offset_deviation (int): Maximum allowed difference between offsets to be considered consistent.
@@ -150,54 +654,78 @@ def is_match(corr_scores, threshold=0.75, min_consistent_offsets=3, max_offset_d
     Returns:
         bool: True if match conditions met, False otherwise.
     """
-    high_corrs = [(c, o) for c, o in corr_scores if c >= threshold]
-    if len(high_corrs) < min_consistent_offsets:
+    high_offsets = offsets[corr >= threshold]
+    if len(high_offsets) < min_consistent_offsets:
         # Not enough high correlation points to call a match
         return False
-    high_corrs.sort(key=lambda x: x[1])
-    offsets = [o for _, o in high_corrs]
-    for i in range(len(offsets)):
-        cluster = [offsets[i]]
-        for j in range(i + 1, len(offsets)):
-            if offsets[j] - cluster[0] <= max_offset_deviation:
-                cluster.append(offsets[j])
-            else:
-                break
-        if len(cluster) >= min_consistent_offsets:
+    high_offsets = numpy.sort(high_offsets)
+    # slide a window of max_offset_deviation over the sorted offsets
+    left = 0
+    for right in range(len(high_offsets)):
+        while high_offsets[right] - high_offsets[left] > max_offset_deviation:
+            left += 1
+        if right - left + 1 >= min_consistent_offsets:
             return True
     return False
 
 def correlate(source_file, fingerprints_dir):
     fingerprints = get_fingerprints(fingerprints_dir)
+    # read all short clip fingerprints once instead of for every source offset,
+    # in parallel as this is mostly waiting for the disk
+    with ThreadPoolExecutor(max_workers=fingerprint_workers) as executor:
+        short_fingerprints = list(zip(fingerprints, executor.map(get_fingerprint, fingerprints)))
+    short_fingerprints = [(path, fp) for path, fp in short_fingerprints if len(fp) > 0]
     duration = get_audio_duration(source_file) # In seconds
     window = sample_time
     step = 10
-    found_songs = []
+    print(f"Fingerprinting {source_file}")
+    try:
+        # fingerprint the whole file once (or reuse it from an earlier run),
+        # the windows are slices of it
+        full_fingerprint = cached_fingerprint(source_file, 0, duration=duration)
+    except Exception as e:
+        print(f"Failed to calculate fingerprint of {source_file}: {e}")
+        print(traceback.format_exc())
+        return []
+    items_per_second = len(full_fingerprint) / duration if duration > 0 else 0
+    # (offset, start, length) of every window within full_fingerprint
+    source_windows = []
     for offset in range(0, duration - window + 1, step):
         #if offset >= 960: # 16 minutes
         #    break
-        print(f"Fingerprinting {source_file} at offset {offset}s")
-        try:
-            source_fingerprint = calculate_fingerprint(source_file, offset, duration=window)
-        except Exception as e:
-            print(f"Failed to calculate fingerprint at offset {offset}: {e}")
-            print(traceback.format_exc())
+        start = int(offset * items_per_second)
+        length = min(int((offset + window) * items_per_second), len(full_fingerprint)) - start
+        if length <= 0:
             continue
-        for short_clip_fp_path in fingerprints:
-            short_fingerprint = get_fingerprint(short_clip_fp_path)
-            if len(short_fingerprint) == 0 or len(source_fingerprint) == 0:
-                continue
-            span_to_use = min(span, min(len(source_fingerprint), len(short_fingerprint)) - 1)
-            if span_to_use < min_overlap:
-                continue
-            corr = compare(source_fingerprint, short_fingerprint, span_to_use, step)
-            offsets = list(numpy.arange(-span_to_use, span_to_use + 1, step))
-            corr_scores = list(zip(corr, offsets))
-            if is_match(corr_scores, threshold=0.60, min_consistent_offsets=1, max_offset_deviation=5):
-                max_corr_index, max_corr_offset = get_max_corr(corr)
-                print(f"Match found between {source_file} (offset {offset}s) and {short_clip_fp_path}")
-                print(f"Correlation: {corr[max_corr_index] * 100.0:.2f}% at offset {max_corr_offset}")
-                found_songs.append((short_clip_fp_path.replace(f"{fingerprints_dir}/", '').replace('.fpcalc', ''), corr[max_corr_index] * 100.0, offset))
-            else:
-                print(f"No match for {short_clip_fp_path} at offset {offset}s")
+        source_windows.append((offset, start, length))
+    found_songs = []
+    match_threshold = 0.60
+    # offsets of the sweep only depend on span_to_use, step is fixed
+    offsets_cache = {}
+    short_clips, short_starts, short_lens = concat_fingerprints([fp for _, fp in short_fingerprints])
+    # the windows are independent, correlate a batch of them in parallel and
+    # evaluate the results afterwards
+    for batch_start in range(0, len(source_windows), window_batch):
+        batch = source_windows[batch_start:batch_start + window_batch]
+        window_starts = [start for _, start, _ in batch]
+        window_lens = [length for _, _, length in batch]
+        spans = numpy.minimum(span, numpy.minimum.outer(window_lens, short_lens) - 1)
+        batch_corr = sweep_windows(full_fingerprint, window_starts, window_lens, short_clips, short_starts, short_lens,
+                                   spans, step, threshold=match_threshold)
+        for (offset, _, _), window_corr, window_spans in zip(batch, batch_corr, spans):
+            for (short_clip_fp_path, _), corr, span_to_use in zip(short_fingerprints, window_corr, window_spans):
+                if span_to_use < min_overlap:
+                    continue
+                corr = corr[:(2 * span_to_use) // step + 1]
+                offsets = offsets_cache.get(span_to_use)
+                if offsets is None:
+                    offsets = numpy.arange(-span_to_use, span_to_use + 1, step)
+                    offsets_cache.update({span_to_use: offsets})
+                if is_match(corr, offsets, threshold=match_threshold, min_consistent_offsets=1, max_offset_deviation=5):
+                    max_corr_index, max_corr_offset = get_max_corr(corr)
+                    print(f"Match found between {source_file} (offset {offset}s) and {short_clip_fp_path}")
+                    print(f"Correlation: {corr[max_corr_index] * 100.0:.2f}% at offset {max_corr_offset}")
+                    found_songs.append((short_clip_fp_path.replace(f"{fingerprints_dir}/", '').replace('.fpcalc', ''), corr[max_corr_index] * 100.0, offset))
+                else:
+                    print(f"No match for {short_clip_fp_path} at offset {offset}s")
     return found_songs
@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+
+# test_correlation.py
+import io
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+
+import correlation
+
+FAKE_FFMPEG = '''#!/bin/sh
+head -c 4000 /dev/zero
+echo "decode error" >&2
+exit $FAKE_FFMPEG_RC
+'''
+
+FAKE_FPCALC = '''#!/bin/sh
+cat > /dev/null
+echo "DURATION=500"
+echo "FINGERPRINT=1,2,3"
+'''
+
+def baseline_is_match(corr_scores, threshold=0.75, min_consistent_offsets=3, max_offset_deviation=5):
+    # the original cluster search over (correlation, offset) pairs
+    high_corrs = [(c, o) for c, o in corr_scores if c >= threshold]
+    if len(high_corrs) < min_consistent_offsets:
+        return False
+    high_corrs.sort(key=lambda x: x[1])
+    offsets = [o for _, o in high_corrs]
+    for i in range(len(offsets)):
+        cluster = [offsets[i]]
+        for j in range(i + 1, len(offsets)):
+            if offsets[j] - cluster[0] <= max_offset_deviation:
+                cluster.append(offsets[j])
+            else:
+                break
+        if len(cluster) >= min_consistent_offsets:
+            return True
+    return False
+
+def reference_sweep(x, y, span, step):
+    # the original one slice per offset implementation
+    corr_xy = [correlation.cross_correlation(x, y, offset) for offset in numpy.arange(-span, span + 1, step)]
+    return numpy.array(corr_xy, dtype=float)
+
+def random_pair(rng, max_len):
+    x = numpy.array([rng.getrandbits(32) for _ in range(rng.randint(1, max_len))], dtype=numpy.uint32)
+    y = numpy.array([rng.getrandbits(32) for _ in range(rng.randint(1, max_len))], dtype=numpy.uint32)
+    # let y resemble part of x so some offsets correlate well
+    n = min(len(x), len(y))
+    y[:n] = x[:n] ^ (y[:n] & numpy.uint32(0x01010101))
+    return x, y
+
+def available_backends():
+    backends = []
+    if correlation._native is not None:
+        backends.append(('native', {'_native': correlation._native}))
+    if correlation._numba_kernels:
+        backends.append(('numba', {'_native': None}))
+    backends.append(('numpy', {'_native': None, '_numba_kernels': False}))
+    return backends
+
+class SweepTest(unittest.TestCase):
+    def for_each_backend(self, check):
+        # force each backend in turn, later ones are the fallbacks of earlier ones
+        for name, overrides in available_backends():
+            with self.subTest(backend=name), mock.patch.multiple(correlation, **overrides):
+                check()
+
+    def test_sweep_matches_cross_correlation(self):
+        rng = random.Random(1)
+        cases = [random_pair(rng, 80) + (rng.randint(0, 100), rng.randint(1, 12)) for _ in range(300)]
+        # lengths below min_overlap and spans beyond the lengths
+        cases.append((numpy.arange(5, dtype=numpy.uint32), numpy.arange(30, dtype=numpy.uint32), 40, 1))
+        def check():
+            for x, y, span, step in cases:
+                numpy.testing.assert_allclose(correlation.sweep(x, y, span, step), reference_sweep(x, y, span, step))
+        self.for_each_backend(check)
+
+    def test_sweep_threshold_keeps_high_correlations(self):
+        rng = random.Random(2)
+        cases = [random_pair(rng, 2000) + (rng.randint(0, 150), rng.randint(1, 10)) for _ in range(50)]
+        def check():
+            for x, y, span, step in cases:
+                expected = reference_sweep(x, y, span, step)
+                corr = correlation.sweep(x, y, span, step, threshold=0.6)
+                # abandoned offsets are NaN, but only ones below the threshold
+                high = expected >= 0.6
+                numpy.testing.assert_allclose(corr[high], expected[high])
+                self.assertFalse(numpy.any(corr[~high] >= 0.6))
+        self.for_each_backend(check)
+
+    def test_sweep_windows_matches_pairwise_sweep(self):
+        rng = random.Random(3)
+        source = numpy.array([rng.getrandbits(32) for _ in range(3000)], dtype=numpy.uint32)
+        # the second and last windows and the last clip are shorter than min_overlap
+        window_starts = [0, 5, 400, 2990]
+        window_lens = [1000, 15, 800, 10]
+        clip_list = [source[420:1200].copy(), source[3:50].copy(), numpy.arange(8, dtype=numpy.uint32)]
+        clips, clip_starts, clip_lens = correlation.concat_fingerprints(clip_list)
+        spans = numpy.minimum(150, numpy.minimum.outer(window_lens, clip_lens) - 1)
+        step = 10
+        def check(threshold):
+            corr = correlation.sweep_windows(source, window_starts, window_lens, clips, clip_starts, clip_lens,
+                                             spans, step, threshold=threshold)
+            for w, (start, length) in enumerate(zip(window_starts, window_lens)):
+                for c, clip in enumerate(clip_list):
+                    if spans[w, c] < correlation.min_overlap:
+                        self.assertTrue(numpy.all(numpy.isnan(corr[w, c])))
+                        continue
+                    expected = reference_sweep(source[start:start + length], clip, int(spans[w, c]), step)
+                    pair = corr[w, c, :len(expected)]
+                    self.assertTrue(numpy.all(numpy.isnan(corr[w, c, len(expected):])))
+                    high = expected >= threshold
+                    numpy.testing.assert_allclose(pair[high], expected[high])
+                    self.assertFalse(numpy.any(pair[~high] >= threshold))
+        self.for_each_backend(lambda: check(0.0))
+        self.for_each_backend(lambda: check(0.6))
+
+class IsMatchTest(unittest.TestCase):
+    def test_matches_baseline(self):
+        rng = random.Random(1)
+        for _ in range(5000):
+            n = rng.randint(0, 20)
+            # NaN marks offsets that were not computed, they never count as high
+            corr = numpy.array([numpy.nan if rng.random() < 0.2 else rng.random() for _ in range(n)])
+            offsets = numpy.array([rng.randint(-30, 30) for _ in range(n)], dtype=int)
+            args = (rng.random(), rng.randint(0, 5), rng.randint(0, 8))
+            with self.subTest(corr=corr, offsets=offsets, args=args):
+                self.assertEqual(correlation.is_match(corr, offsets, *args),
+                                 baseline_is_match(list(zip(corr, offsets)), *args))
+
+class MaxIndexTest(unittest.TestCase):
+    def test_first_maximum(self):
+        self.assertEqual(correlation.max_index([0.5, 0.9, 0.2, 0.9]), 1)
+        self.assertEqual(correlation.max_index(numpy.array([0.7])), 0)
+
+    def test_ignores_nan(self):
+        # sweeps leave NaN at offsets with too little overlap, at either end
+        self.assertEqual(correlation.max_index(numpy.array([numpy.nan, 0.4, 0.8, numpy.nan])), 2)
+        self.assertEqual(correlation.max_index(numpy.array([0.3, numpy.nan, 0.1])), 0)
+        self.assertEqual(correlation.max_index(numpy.array([numpy.nan, numpy.nan, 0.1])), 2)
+
+class FakeChromaprint:
+    # records the samples fed to it and returns an empty fingerprint
+    def __init__(self):
+        self.fed = []
+
+    def chromaprint_new(self, algorithm):
+        return 1
+
+    def chromaprint_start(self, ctx, sample_rate, num_channels):
+        return 1
+
+    def chromaprint_feed(self, ctx, samples, size):
+        self.fed.append(samples.copy())
+        return 1
+
+    def chromaprint_finish(self, ctx):
+        return 1
+
+    def chromaprint_get_raw_fingerprint(self, ctx, fingerprint, size):
+        return 1
+
+    def chromaprint_dealloc(self, ptr):
+        pass
+
+    def chromaprint_free(self, ctx):
+        pass
+
+def synthetic_pcm(seconds):
+    # a few tones over noise, enough for chromaprint to produce a fingerprint
+    rng = numpy.random.default_rng(1)
+    t = numpy.arange(seconds * correlation.pcm_rate) / correlation.pcm_rate
+    mono = sum(numpy.sin(2 * numpy.pi * f * t * (1 + 0.1 * numpy.sin(t))) for f in (220, 440, 660, 1250))
+    mono = 5000 * mono + rng.normal(0, 1000, len(t))
+    return numpy.repeat(mono, correlation.pcm_channels).astype('<i2').tobytes()
+
+class ChromaprintTest(unittest.TestCase):
+    def test_feeds_little_endian_pcm(self):
+        lib = FakeChromaprint()
+        samples = numpy.array([1, -2, 300, -30000, 2 ** 15 - 1], dtype=numpy.int16)
+        with mock.patch.object(correlation, '_chromaprint', lib):
+            correlation._chromaprint_feed_stream(io.BytesIO(samples.astype('<i2').tobytes()))
+        fed = numpy.concatenate(lib.fed)
+        self.assertTrue(fed.dtype.isnative)
+        numpy.testing.assert_array_equal(fed, samples)
+
+    @unittest.skipUnless(correlation._chromaprint is not None and shutil.which('fpcalc'), 'needs libchromaprint and fpcalc')
+    def test_matches_fpcalc(self):
+        with tempfile.NamedTemporaryFile(suffix='.raw') as pcm:
+            pcm.write(synthetic_pcm(30))
+            pcm.flush()
+            out = subprocess.check_output(['fpcalc', '-raw', '-length', '30', '-format', 's16le', '-rate', str(correlation.pcm_rate),
+                                           '-channels', str(correlation.pcm_channels), pcm.name]).decode()
+            expected = numpy.fromstring(out[out.find('FINGERPRINT=') + 12:], dtype=numpy.uint32, sep=',')
+            pcm.seek(0)
+            fingerprints = correlation._chromaprint_feed_stream(pcm)
+        self.assertGreater(len(expected), 0)
+        numpy.testing.assert_array_equal(fingerprints, expected)
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        # fake decoders on PATH, fingerprinting through fpcalc
+        bin_dir = os.path.join(tmp.name, 'bin')
+        os.mkdir(bin_dir)
+        for name, script in (('ffmpeg', FAKE_FFMPEG), ('fpcalc', FAKE_FPCALC)):
+            with open(os.path.join(bin_dir, name), 'w') as f:
+                f.write(script)
+            os.chmod(os.path.join(bin_dir, name), 0o755)
+        env = {'PATH': bin_dir + os.pathsep + os.environ['PATH'], 'FAKE_FFMPEG_RC': '0'}
+        for patcher in (mock.patch.dict(os.environ, env),
+                        mock.patch.multiple(correlation, cache_dir=os.path.join(tmp.name, 'cache'), _chromaprint=None)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.source = os.path.join(tmp.name, 'source.wav')
+        with open(self.source, 'wb') as f:
+            f.write(b'audio')
+
+    def cache_entries(self):
+        cache = os.path.join(correlation.cache_dir, 'fingerprints')
+        return os.listdir(cache) if os.path.isdir(cache) else []
+
+    def test_reuses_entry(self):
+        fingerprints = correlation.cached_fingerprint(self.source)
+        self.assertEqual(len(self.cache_entries()), 1)
+        with mock.patch.object(correlation, 'calculate_fingerprint') as calculate:
+            numpy.testing.assert_array_equal(correlation.cached_fingerprint(self.source), fingerprints)
+        calculate.assert_not_called()
+
+    def test_failed_decode_is_not_cached(self):
+        os.environ['FAKE_FFMPEG_RC'] = '1'
+        with self.assertRaisesRegex(RuntimeError, 'ffmpeg failed'):
+            correlation.cached_fingerprint(self.source)
+        self.assertEqual(self.cache_entries(), [])
+
+    def test_recovers_from_unreadable_entry(self):
+        correlation.cached_fingerprint(self.source)
+        path = os.path.join(correlation.cache_dir, 'fingerprints', self.cache_entries()[0])
+        # an empty file as left by a crash, and one that is not .npy at all
+        for content in (b'', b'not a numpy file'):
+            with open(path, 'wb') as f:
+                f.write(content)
+            numpy.testing.assert_array_equal(correlation.cached_fingerprint(self.source), [1, 2, 3])
+            numpy.testing.assert_array_equal(numpy.load(path), [1, 2, 3])
+
+    def test_input_without_file_is_not_cached(self):
+        numpy.testing.assert_array_equal(correlation.cached_fingerprint('http://example.com/source.mp3'), [1, 2, 3])
+        self.assertEqual(self.cache_entries(), [])
+
+if __name__ == '__main__':
+    unittest.main()